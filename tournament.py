@@ -1,13 +1,92 @@
 #!/usr/bin/env python
 """Tournament.py - implementation of a Swiss-system tournament."""
 
-import psycopg2
+from contextlib import contextmanager
+from weakref import WeakSet
+
+import networkx as nx
+
+try:
+    import psycopg2  # noqa: F401
+except ImportError:
+    # PyPy: psycopg2cffi provides the same API under the psycopg2 name
+    from psycopg2cffi import compat
+    compat.register()
+
 from psycopg2 import DatabaseError
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+DSN = "dbname=tournament"
+
+# Connections are shared through a pool instead of opening a new one per
+# query; it is created on first use so importing the module needs no database.
+_pool = None
+
+# Hot statements are prepared once on each connection, so that the server
+# doesn't parse and plan them again on every call.  Prepared statements last
+# as long as the connection, whatever happens to the current transaction.
+_PREPARED_STATEMENTS = """
+    PREPARE insert_match(int, int) AS
+        INSERT INTO matches(winner, loser) VALUES ($1, $2);
+    PREPARE player_standings AS
+        SELECT id, name, wins, matches FROM view_player_standings;
+"""
+_prepared_conns = WeakSet()
+
+
+def _get_conn():
+    """Borrow a connection from the pool.  Returns a database connection.
+
+    The hot statements are prepared the first time a connection is borrowed.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ThreadedConnectionPool(minconn=1, maxconn=8, dsn=DSN)
+    db_conn = _pool.getconn()
+    if db_conn not in _prepared_conns:
+        try:
+            db_conn.cursor().execute(_PREPARED_STATEMENTS)
+        except DatabaseError:
+            _pool.putconn(db_conn)
+            raise
+        _prepared_conns.add(db_conn)
+    return db_conn
+
+
+def _put_conn(db_conn):
+    """Return a borrowed connection to the pool.
+
+    Any transaction left open on the connection is rolled back by the pool.
+    """
+    _pool.putconn(db_conn)
+
+
+def close_connections():
+    """Close all the pooled connections.
+
+    A new pool is created the next time the database is queried.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
 
 
-def connect():
-    """Connect to the PostgreSQL database.  Returns a database connection."""
-    return psycopg2.connect("dbname=tournament")
+@contextmanager
+def _cursor():
+    """Yield a cursor on a pooled connection, inside a transaction.
+
+    The transaction is committed if the block succeeds and rolled back if it
+    raises; the connection is given back to the pool in both cases.
+    """
+    db_conn = _get_conn()
+    try:
+        with db_conn:
+            with db_conn.cursor() as cursor:
+                yield cursor
+    finally:
+        _put_conn(db_conn)
 
 
 def execute(query, values=()):
@@ -19,14 +98,30 @@ def execute(query, values=()):
 
     Raises DatabaseError if query couldn't be executed.
     """
-    db_conn = connect()
-    cursor = db_conn.cursor()
-    try:
+    with _cursor() as cursor:
         cursor.execute(query, values)
-        db_conn.commit()
-    except DatabaseError as e:
-        print e.message
-    db_conn.close()
+
+
+def insert_values(query, values, page_size=1000, fetch=False):
+    """Insert many rows of values with a single merged statement.
+
+    The rows are merged into the query's VALUES list, unlike executemany
+    which runs the query once per row.
+
+    Args:
+        query: INSERT query to execute, with a single %s placeholder standing
+            for the whole VALUES list
+        values: list of tuples with query values
+        page_size: maximum number of rows sent in one statement
+        fetch: whether to return the rows of a RETURNING clause
+
+    Returns a list of tuples with the returned rows if fetch is True.
+
+    Raises DatabaseError if query couldn't be executed.
+    """
+    with _cursor() as cursor:
+        return execute_values(
+            cursor, query, values, page_size=page_size, fetch=fetch)
 
 
 def fetch_one(query):
@@ -37,12 +132,9 @@ def fetch_one(query):
 
     Returns first value from the result tuple.
     """
-    db_conn = connect()
-    cursor = db_conn.cursor()
-    cursor.execute(query)
-    result = cursor.fetchone()
-    db_conn.close()
-    return result[0]
+    with _cursor() as cursor:
+        cursor.execute(query)
+        return cursor.fetchone()[0]
 
 
 def fetch_all(query, values=()):
@@ -54,29 +146,35 @@ def fetch_all(query, values=()):
 
     Returns a list of tuples with the results.
     """
-    db_conn = connect()
-    cursor = db_conn.cursor()
-    cursor.execute(query, values)
-    results = cursor.fetchall()
-    db_conn.close()
-    return results
+    with _cursor() as cursor:
+        cursor.execute(query, values)
+        return cursor.fetchall()
+
+
+def reset_tournament():
+    """Remove all the match and player records from the database.
+
+    The players' id sequence is restarted as well.
+    """
+    query = "TRUNCATE matches, players RESTART IDENTITY CASCADE"
+    execute(query)
 
 
 def delete_matches():
     """Remove all the match records from the database."""
-    query = "DELETE FROM matches"
+    query = "TRUNCATE matches"
     execute(query)
 
 
 def delete_players():
-    """Remove all the player records from the database."""
-    query = "DELETE FROM players"
+    """Remove all the player records, and their matches, from the database."""
+    query = "TRUNCATE players CASCADE"
     execute(query)
 
 
 def count_players():
     """Return the number of players currently registered."""
-    query = "SELECT COUNT(id) FROM players"
+    query = "SELECT COUNT(*) FROM players"
     return fetch_one(query)
 
 
@@ -88,9 +186,25 @@ def register_player(name):
 
     Args:
       name: the player's full name (need not be unique).
+
+    Returns:
+      The player's id.
+    """
+    return register_players([name])[0]
+
+
+def register_players(names):
+    """Add many players to the tournament database with a single query.
+
+    Args:
+      names: a list with the players' full names.
+
+    Returns:
+      A list with the players' ids, in the same order as names.
     """
-    query = "INSERT INTO players(name) VALUES (%s)"
-    execute(query, (name,))
+    query = "INSERT INTO players(name) VALUES %s RETURNING id"
+    results = insert_values(query, [(name,) for name in names], fetch=True)
+    return [res[0] for res in results]
 
 
 def player_standings():
@@ -106,12 +220,7 @@ def player_standings():
         wins: the number of matches the player has won
         matches: the number of matches the player has played
     """
-    query = '''
-        SELECT v1.id, v1.name, v1.wins, v2.matches
-        FROM view_player_id_name_won_matches as v1, view_player_matches as v2
-        WHERE v1.id = v2.id
-        ORDER BY v1.wins desc
-    '''
+    query = "EXECUTE player_standings"
     return fetch_all(query)
 
 
@@ -122,11 +231,21 @@ def report_match(winner, loser):
       winner:  the id number of the player who won
       loser:  the id number of the player who lost
     """
-    query = "INSERT INTO matches(winner, loser) VALUES (%s, %s)"
+    query = "EXECUTE insert_match(%s, %s)"
     execute(query, (winner, loser))
 
 
-def swiss_pairings():
+def report_matches(matches):
+    """Record the outcome of many matches with a single query.
+
+    Args:
+      matches: a list of tuples, each of which contains (winner, loser)
+    """
+    query = "INSERT INTO matches(winner, loser) VALUES %s"
+    insert_values(query, matches)
+
+
+def swiss_pairings(standings=None):
     """Return a list of pairs of players for the next round of a match.
 
     Assuming that there are an even number of players registered, each player
@@ -134,6 +253,11 @@ def swiss_pairings():
     player with an equal or nearly-equal win record, that is, a player adjacent
     to him or her in the standings.
 
+    Args:
+      standings: the current player_standings(), if the caller has already
+        fetched them; they are fetched otherwise.  Only the players in the
+        standings are paired, according to their wins in the standings.
+
     Returns:
       A list of tuples, each of which contains (id1, name1, id2, name2)
         id1: the first player's unique id
@@ -141,154 +265,109 @@ def swiss_pairings():
         id2: the second player's unique id
         name2: the second player's name
     """
-    standings = player_standings()
-    possible_matches = _get_possible_matches_for_next_round(standings)
-    names, wins = _get_names_and_wins(standings)
+    if standings is None:
+        standings = player_standings()
+    possible_matches = _get_possible_matches_for_next_round()
+    names = {}
+    wins = {}
+    for (id_player, name, win, matches) in standings:
+        names[id_player] = name
+        wins[id_player] = win
     graph = _build_graph(possible_matches, wins)
-
-    shortest_path = _get_next_matches_ids(graph)
+    count_p = len(standings)
 
     next_matches = []
-    for shp in shortest_path:
-        next_matches.append((shp[1], names[shp[1]], shp[2], names[shp[2]]))
+    for (id_player1, id_player2) in _get_next_matches_ids(graph, count_p):
+        next_matches.append(
+            (id_player1, names[id_player1], id_player2, names[id_player2]))
     return next_matches
 
 
-def _get_possible_matches_for_next_round(standings):
+def _get_possible_matches_for_next_round():
     """Return possible next matches for next round.
 
-    Args:
-        standings: actual standings for each player
+    All the pairs of players that haven't met yet are fetched with a single
+    query.
 
     Returns:
-        A dictionary with possible next matches for each player
-        {id1: [id2, id3, ...], id2: [id1, id4, id5...], ...}
+        A list of tuples, one for each possible match:
+        [(id1, id2), (id1, id3), (id2, id4), ...]
 
-        idn: a player's unique id
+        idn: a player's unique id, the smaller one first
     """
-    possible_matches = {}
-
-    for (id_player, name, win, matches) in standings:
-        query = """SELECT p.id
-            FROM players p WHERE p.id NOT IN (
-                SELECT m.winner
-                FROM matches m
-                WHERE  m.loser = %s
-            ) AND p.id NOT IN (
-                SELECT m.loser
-                FROM matches m
-                WHERE  m.winner = %s
-            ) AND p.id != %s
-            """
-        results = fetch_all(query, (id_player, id_player, id_player))
-        possible_matches[id_player] = [res[0] for res in results]
-    return possible_matches
-
-
-def _get_names_and_wins(standings):
-    """Return nr of wins and the name for each player.
-
-    Args:
-        standings: actual standings for each player
-
-    Returns:
-        2 lists:
-        wins = {'id1': 2, 'id2': 1, ...}
-        names = {'id1': 'Player 1', 'id2': 'Player 2', ...}
-
-        idn: a player's unique id
+    query = """
+        WITH played AS (
+            SELECT winner AS a, loser AS b FROM matches
+            UNION ALL
+            SELECT loser, winner FROM matches
+        )
+        SELECT p1.id, p2.id
+        FROM players p1 JOIN players p2 ON p1.id < p2.id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM played WHERE a = p1.id AND b = p2.id
+        )
     """
-    wins = {}
-    names = {}
-    for (i, n, w, m) in standings:
-        wins[i] = w
-        names[i] = n
-
-    return names, wins
+    return fetch_all(query)
 
 
 def _build_graph(possible_matches, wins):
-    """Return all possible combinations of next matches and their weight.
+    """Return a graph with all possible next matches and their weight.
 
     Args:
-        possible_matches
-        wins: used to calculate weight of a match
+        possible_matches: list with the ids of the players of each possible
+            match
+        wins: used to calculate weight of a match; matches of players
+            missing from wins, who aren't in the standings, are left out
 
     Returns:
-        A list of tuples: [(weight1, id1, id2), (weight2, id1, id4), ...]
-
-        weightn: the difference of wins between id1 and id2
-        idn: a player's unique id
+        A networkx Graph with a node for each player and an edge for each
+        possible match, weighted by how close the players' win records are:
+        weight = top - abs(wins[id1] - wins[id2])
 
-        The list is sorted after weight
+        top: a constant bigger than any difference of wins, so that every
+        weight is positive and a maximum weight matching is a matching with
+        the minimum sum of differences of wins
     """
-    graph = []
-    for id_player1 in possible_matches:
-        for id_player2 in possible_matches[id_player1]:
-            weight = abs(wins[id_player1] - wins[id_player2])
-            graph.append(
-                (weight, id_player1, id_player2))
-
-    graph.sort()
+    top = max(wins.values() or [0]) + 1
+    graph = nx.Graph()
+    graph.add_weighted_edges_from(
+        (id_player1, id_player2,
+         top - abs(wins[id_player1] - wins[id_player2]))
+        for (id_player1, id_player2) in possible_matches
+        if id_player1 in wins and id_player2 in wins)
     return graph
 
 
-def _get_next_matches_ids(graph):
+def _get_next_matches_ids(graph, count_p):
     """Find best pairs of matches for next round.
 
+    The pairs are a maximum cardinality matching with maximum weight of the
+    graph, computed with Edmonds' blossom algorithm in O(n^3).
+
     Args:
-        graph: a list of tuples that contains every possible next match
+        graph: a graph that contains every possible next match
+        count_p: number of players
 
     Returns:
-        set([(weight1, id1, id2), (weight2, id3, id4), ...])
+        [(id1, id2), (id3, id4), ...]
 
-        weightn: the difference of wins between id1 and id2
         idn: a player's unique id
-    """
-    count_p = count_players()
-
-    paths = []
-    for i in range(len(graph)):
-        count, path = find_path(graph, graph[i], count_p, [], set())
-        if len(path) == (count_p / 2):
-            paths.append((count, path))
-
-    # Chose the path that has minimum weight
-    paths.sort()
-    chosen_path = paths[0][1]
-
-    return chosen_path
 
-
-def find_path(graph, start, nr_players, nodes, path=set(), count=0):
-    """Determine a set of possible matches for a round.
-
-    Args:
-        graph: all possible matches
-        start: chosen starting match
-        nr_players: number of players
-        nodes: a list with all players from chosen matches
-        path: a list with chosen matches
-        count: the sum of all chosen matches weights
-
-    Returns:
-        count/new_count - the sum of all chosen matches weights
-        path/new_path  - a list with all matches
+    Raises ValueError if the players can't all be paired.
     """
-    weight, id_player1, id_player2 = start
-    nodes.append(id_player1)
-    nodes.append(id_player2)
-    path.add(start)
-    count += weight
-
-    if len(nodes) == nr_players:
-        return count, path
-    for edge in graph:
-        weight1, id_player1, id_player2 = edge
-        if id_player1 not in nodes and id_player2 not in nodes:
-            new_count, new_path = find_path(
-                graph, edge, nr_players, nodes, path, count)
-            if new_path:
-                return new_count, new_path
-
-    return 0, set()
+    matching = nx.max_weight_matching(graph, maxcardinality=True)
+    if 2 * len(matching) != count_p:
+        raise ValueError("The players can't all be paired for next round.")
+
+    return sorted(tuple(sorted(pair)) for pair in matching)
+
+
+# Aliases with the function names of the original Udacity tournament API, so
+# that callers written against it (and its tournament_test.py) still work.
+deleteMatches = delete_matches
+deletePlayers = delete_players
+countPlayers = count_players
+registerPlayer = register_player
+playerStandings = player_standings
+reportMatch = report_match
+swissPairings = swiss_pairings
@@ -17,6 +17,13 @@ CREATE TABLE matches(
     loser INTEGER REFERENCES players(ID)
 );
 
+-- INDEXES on matches players, used to look up a player's matches
+-- Both columns are covered in each direction, so checking whether two players
+-- have already met (in swiss_pairings and in the rematches trigger) can be
+-- answered from the indexes alone.
+CREATE INDEX matches_winner_loser_idx ON matches(winner, loser);
+CREATE INDEX matches_loser_winner_idx ON matches(loser, winner);
+
 -- TRIGGER PROCEDURE FOR PREVENTING REMATCHES
 -- This procedure prevents adding matches that have already been played.
 -- If we have a match between winner with id: 1, and loser with id: 3, this
@@ -55,22 +62,14 @@ CREATE TRIGGER prevent_rematches
   FOR EACH ROW
   EXECUTE PROCEDURE prevent_rematches_trigger();
 
--- CREATE view_player_id_name_won_matches VIEW
--- This view returns a list of the players (id, name) and their win records, sorted by wins.
-CREATE VIEW view_player_id_name_won_matches AS
-    SELECT p.id, p.name, count(m.winner) as wins
+-- CREATE view_player_standings VIEW
+-- This view returns a list of the players (id, name), their win records and
+-- their nr of matches, sorted by wins. Matches are scanned once for both counts.
+CREATE VIEW view_player_standings AS
+    SELECT p.id, p.name,
+        count(CASE WHEN m.winner = p.id THEN 1 END) as wins,
+        count(m.winner) as matches
     FROM players as p LEFT JOIN matches m
-    ON p.id = m.winner
+    ON p.id = m.winner OR p.id = m.loser
     GROUP BY p.id
     ORDER BY wins DESC;
-
--- CREATE view_player_matches VIEW
--- This view returns the nr of matches of each player.
-CREATE VIEW view_player_matches AS
-    SELECT p.id, count(m.winner + m.loser) as matches
-    FROM players as p LEFT JOIN matches m
-    ON p.id = m.winner OR p.id = m.loser
-    GROUP BY p.id;
-
-
-
@@ -1,25 +1,93 @@
 #!/usr/bin/env python
 """Test cases for tournament.py."""
 
+from __future__ import print_function
+
+import sys
 import unittest
 
+import tournament
 from tournament import delete_matches, delete_players, register_player, \
-    count_players, player_standings, swiss_pairings, report_match
+    count_players, player_standings, swiss_pairings, report_match, \
+    reset_tournament, close_connections, register_players, report_matches
 
 from math import log
+import psycopg2
 from psycopg2 import DatabaseError
+from psycopg2.extensions import connection
+
+
+def setUpModule():
+    """Start the tests from empty tables, with a single committed reset."""
+    reset_tournament()
+
+
+def tearDownModule():
+    """Close the database connections shared through tournament's pool."""
+    close_connections()
+
+
+class RollbackConnection(connection):
+    """Connection that leaves ending its transaction to the test.
+
+    The tournament queries' commits and rollbacks do nothing, so everything
+    a test writes stays in one transaction that is discarded with discard().
+    """
+
+    def commit(self):
+        """Keep the changes in the test's transaction."""
+
+    def rollback(self):
+        """Leave the test's transaction to discard()."""
+
+    def discard(self):
+        """Roll back the test's transaction."""
+        super(RollbackConnection, self).rollback()
+
+
+class RollbackPool(object):
+    """Pool lending the same RollbackConnection to every query."""
+
+    def __init__(self, db_conn):
+        """Lend db_conn."""
+        self.db_conn = db_conn
+
+    def getconn(self):
+        """Return the connection."""
+        return self.db_conn
+
+    def putconn(self, db_conn):
+        """Nothing to do, the connection is kept for the next query."""
 
 
 class TournamentTestBasic(unittest.TestCase):
     """Basic Tournament Class."""
 
+    @classmethod
+    def setUpClass(cls):
+        """Open the connection used by the tests."""
+        cls.db_conn = psycopg2.connect(
+            tournament.DSN, connection_factory=RollbackConnection)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Close the connection used by the tests."""
+        cls.db_conn.close()
+
     def setUp(self):
-        """Clean database before each test.
+        """Run each test in a transaction that is rolled back afterwards.
 
-        Reset the matches and players.
+        The tables are emptied once by setUpModule, and the tournament
+        queries use the test's connection, which never commits, so each test
+        starts from empty tables without resetting them.
         """
-        delete_matches()
-        delete_players()
+        self.pool = tournament._pool
+        tournament._pool = RollbackPool(self.db_conn)
+
+    def tearDown(self):
+        """Discard everything the test wrote and restore the pool."""
+        self.db_conn.discard()
+        tournament._pool = self.pool
 
     def _register_players(self, players):
         """Register a list of players in the database.
@@ -27,9 +95,10 @@ class TournamentTestBasic(unittest.TestCase):
         Args:
             players
 
+        Returns:
+            the ids of the registered players
         """
-        for player in players:
-            register_player(player)
+        return register_players(players)
 
 
 class TournamentTestCount(TournamentTestBasic):
@@ -42,26 +111,26 @@ class TournamentTestCount(TournamentTestBasic):
         msg_error = "count_players should return numeric zero, not string '0'."
         self.assertNotEqual(c, '0', msg_error)
         msg = "1. count_players() returns 0 after initial"
-        print msg + " delete_players() execution."
+        print(msg + " delete_players() execution.")
 
     def test_count_after_players_are_registered(self):
         """Test player count after 1 and 2 players registered."""
         register_player("Chandra Nalaar")
         self._assert_count_players(
             1, "After one player registers, count_players() should be 1.")
-        print "2. count_players() returns 1 after one player is registered."
+        print("2. count_players() returns 1 after one player is registered.")
 
         register_player("Jace Beleren")
         self._assert_count_players(
             2, "After two players register, count_players() should be 2.")
-        print "3. count_players() returns 2 after two players are registered."
+        print("3. count_players() returns 2 after two players are registered.")
 
         delete_players()
         self._assert_count_players(
             0, "After deletion, count_players should return zero.")
         msg = "4. count_players() returns zero after "
-        print msg + "registered players are deleted.\n" \
-            "5. Player records successfully deleted."
+        print(msg + "registered players are deleted.\n"
+              "5. Player records successfully deleted.")
 
     def _assert_count_players(self, expected_count_players, message):
         c = count_players()
@@ -84,7 +153,7 @@ class TournamentTestStandings(TournamentTestBasic):
         self._assert_standings_length(standings)
         self._assert_standings_values(standings)
         msg = "6. Newly registered players appear"
-        print msg + " in the standings with no matches."
+        print(msg + " in the standings with no matches.")
 
     def _assert_standings_length(self, standings):
         self.assertFalse(len(standings) < 2, "Players should appear in \
@@ -116,20 +185,17 @@ class TournamentTestTReportMatches(TournamentTestBasic):
 
         Test to confirm matches are deleted properly.
         """
-        self._register_players(
+        [id1, id2, id3, id4] = self._register_players(
             ["Bruno Walton", "Boots O'Neal", "Cathy Burton", "Diane Grant"])
-
-        standings = player_standings()
-        [id1, id2, id3, id4] = [row[0] for row in standings]
         report_match(id1, id2)
         report_match(id3, id4)
         self._assert_standings_values_after_first_round(id1, id2, id3, id4)
-        print "7. After a match, players have updated standings."
+        print("7. After a match, players have updated standings.")
 
         delete_matches()
         self._assert_standings_values_after_delete_matches()
-        print "8. After match deletion, player standings are properly reset."
-        print "9. Matches are properly deleted."
+        print("8. After match deletion, player standings are properly reset.")
+        print("9. Matches are properly deleted.")
 
     def _assert_standings_values_after_first_round(self, id1, id2, id3, id4):
         standings = player_standings()
@@ -169,11 +235,8 @@ class TournamentTestUPairings(TournamentTestBasic):
         players = ["Twilight Sparkle", "Fluttershy", "Applejack", "Pinkie Pie",
                    "Rarity", "Rainbow Dash", "Princess Celestia",
                    "Princess Luna"]
-        self._register_players(players)
-
-        standings = player_standings()
-        [id1, id2, id3, id4, id5, id6, id7, id8] = [row[0]
-                                                    for row in standings]
+        [id1, id2, id3, id4, id5, id6, id7, id8] = \
+            self._register_players(players)
         self._assert_pairings_length()
 
         self._register_first_round(id1, id2, id3, id4, id5, id6, id7, id8)
@@ -182,7 +245,7 @@ class TournamentTestUPairings(TournamentTestBasic):
         self._assert_pairings_after_first_round(
             pairings, id1, id2, id3, id4, id5, id6, id7, id8)
 
-        print "10. After one match, players with one win are properly paired."
+        print("10. After one match, players with one win are properly paired.")
 
     def _assert_pairings_length(self):
         pairings = swiss_pairings()
@@ -192,29 +255,21 @@ class TournamentTestUPairings(TournamentTestBasic):
         return pairings
 
     def _register_first_round(self, id1, id2, id3, id4, id5, id6, id7, id8):
-        report_match(id1, id2)
-        report_match(id3, id4)
-        report_match(id5, id6)
-        report_match(id7, id8)
+        report_matches([(id1, id2), (id3, id4), (id5, id6), (id7, id8)])
 
     def _assert_pairings_after_first_round(self, pairings, id1, id2, id3, id4,
                                            id5, id6, id7, id8):
-        [(pid1, pname1, pid2, pname2), (pid3, pname3, pid4, pname4),
-         (pid5, pname5, pid6, pname6), (pid7, pname7, pid8, pname8)] = pairings
-        possible_pairs = set([frozenset([id1, id3]), frozenset([id1, id5]),
-                              frozenset([id1, id7]), frozenset([id3, id5]),
-                              frozenset([id3, id7]), frozenset([id5, id7]),
-                              frozenset([id2, id4]), frozenset([id2, id6]),
-                              frozenset([id2, id8]), frozenset([id4, id6]),
-                              frozenset([id4, id8]), frozenset([id6, id8])
-                              ])
-        actual_pairs = set(
-            [frozenset([pid1, pid2]), frozenset([pid3, pid4]),
-                frozenset([pid5, pid6]), frozenset([pid7, pid8])])
-        for pair in actual_pairs:
+        winners = (id1, id3, id5, id7)
+        losers = (id2, id4, id6, id8)
+        # a pair of players is represented by a bitmask with their ids' bits
+        possible_pairs = {(1 << a) | (1 << b)
+                          for group in (winners, losers)
+                          for i, a in enumerate(group)
+                          for b in group[i + 1:]}
+        for (pid1, pname1, pid2, pname2) in pairings:
             self.assertIn(
-                pair, possible_pairs, "After one match, players with one win \
-                should be paired.")
+                (1 << pid1) | (1 << pid2), possible_pairs, "After one match, \
+                players with one win should be paired.")
 
 
 class TournamentTestZExtras(TournamentTestBasic):
@@ -225,22 +280,100 @@ class TournamentTestZExtras(TournamentTestBasic):
 
         Test that the system prevent matches between a player and himself.
         """
+        [id1, id2, id3, id4] = self._register_players(
+            ["Bruno Walton", "Boots O'Neal", "Cathy Burton", "Diane Grant"])
+        report_matches([(id1, id2), (id3, id4)])
+        self._assert_report_match_fails(id2, id1)
+        self._assert_report_match_fails(id2, id2)
+        print("11. Rematches are properly prevented.")
+
+    def _assert_report_match_fails(self, winner, loser):
+        """Assert that reporting a match raises DatabaseError.
+
+        The failing insert runs in a savepoint, so that the test's
+        transaction can go on after it.
+        """
+        cursor = self.db_conn.cursor()
+        cursor.execute("SAVEPOINT report_match")
+        self.assertRaises(DatabaseError, report_match, winner, loser)
+        cursor.execute("ROLLBACK TO SAVEPOINT report_match")
+
+    def test_unpairable_players(self):
+        """Test that pairings fail when not every player can be paired.
+
+        Test this with an odd number of players, and with players that have
+        all already played each other.
+        """
         self._register_players(
+            ["Bruno Walton", "Boots O'Neal", "Cathy Burton"])
+        self.assertRaises(ValueError, swiss_pairings)
+
+        reset_tournament()
+        [id1, id2, id3, id4] = self._register_players(
             ["Bruno Walton", "Boots O'Neal", "Cathy Burton", "Diane Grant"])
+        report_matches([(id1, id2), (id3, id4), (id1, id3), (id2, id4),
+                        (id1, id4), (id2, id3)])
+        self.assertRaises(ValueError, swiss_pairings)
+        print("12. Players that can't all be paired are reported.")
+
+    def test_pairings_with_given_standings(self):
+        """Test that pairings only use the standings they are given.
 
+        Players registered after the standings were fetched are not paired.
+        """
+        [id1, id2, id3, id4] = self._register_players(
+            ["Bruno Walton", "Boots O'Neal", "Cathy Burton", "Diane Grant"])
+        report_matches([(id1, id2), (id3, id4)])
         standings = player_standings()
-        [id1, id2, id3, id4] = [row[0] for row in standings]
+        self._register_players(["Twilight Sparkle", "Fluttershy"])
+
+        pairings = swiss_pairings(standings)
+        actual_pairs = set(frozenset((pid1, pid2))
+                           for (pid1, pname1, pid2, pname2) in pairings)
+        self.assertEqual(
+            actual_pairs, {frozenset((id1, id3)), frozenset((id2, id4))},
+            "Pairings should only pair the players of the given standings, \
+            by their wins in those standings.")
+        print("13. Pairings are computed from the given standings.")
+
+
+class TournamentTestZPool(unittest.TestCase):
+    """Tournament Connection Pool Test.
+
+    Unlike the other tests, this one goes through tournament's connection
+    pool and commits what it writes.
+    """
+
+    def tearDown(self):
+        """Remove the committed matches and players."""
+        reset_tournament()
+
+    def test_records_are_committed(self):
+        """Test that records written through the pool are committed.
+
+        They are read back from a separate connection.
+        """
+        [id1, id2] = register_players(["Bruno Walton", "Boots O'Neal"])
         report_match(id1, id2)
-        report_match(id3, id4)
-        self.assertRaises(DatabaseError, report_match(id2, id1))
-        self.assertRaises(DatabaseError, report_match(id2, id2))
-        print "11. Rematches are properly prevented."
+
+        db_conn = psycopg2.connect(tournament.DSN)
+        try:
+            cursor = db_conn.cursor()
+            cursor.execute("SELECT winner, loser FROM matches")
+            matches = cursor.fetchall()
+        finally:
+            db_conn.close()
+        self.assertEqual(matches, [(id1, id2)],
+                         "Reported matches should be committed.")
+        print("14. Records are committed through the connection pool.")
 
 
 class SwissTournament(object):
     """Swiss Tournament display."""
 
     NR_OF_PLAYERS = 16
+    # nr of rounds necessary to determine a winner
+    ROUNDS = int(log(NR_OF_PLAYERS, 2))
 
     def generate_whole_swiss_tournament(self):
         """Display each round statistics in a swiss tournament.
@@ -248,73 +381,61 @@ class SwissTournament(object):
         Display winner's name.
         """
         # clean database
-        delete_matches()
-        delete_players()
+        reset_tournament()
 
-        print '\n\nSWISS TOURNAMENT FOR {0} PLAYERS:'.format(
-            self.NR_OF_PLAYERS)
+        print('\n\nSWISS TOURNAMENT FOR {0} PLAYERS:'.format(
+            self.NR_OF_PLAYERS))
 
         # register {NR_OF_PLAYERS} players
-        i = 0
-        while i < self.NR_OF_PLAYERS:
-            register_player("Player " + str(i + 1))
-            i += 1
-
-        # calculate nr of rounds necessary to determine a winner
-        rounds = log(self.NR_OF_PLAYERS) / log(2)
-        i = 0
-        while i < int(rounds):
+        names = ["Player %d" % (i + 1) for i in xrange(self.NR_OF_PLAYERS)]
+        register_players(names)
+
+        standings = player_standings()
+        for i in xrange(self.ROUNDS):
             # determine next round matches
-            pairings = swiss_pairings()
-            group = {}
-
-            j = 0
-            z = 0
-            # register next round matches
-            while j < self.NR_OF_PLAYERS:
-                (group['pid' + str(j)], group['pname' + str(j)],
-                 group['pid' + str(j + 1)],
-                 group['pname' + str(j + 1)]) = pairings[z]
-                report_match(group['pid' + str(j)], group['pid' + str(j + 1)])
-                j += 2
-                z += 1
-
-            print '\nStats after round: ' + str(i + 1)
-
-            # show round statistics
-            first_player = self.stats()
-            print '\n'
-            i += 1
-
-        print "-------------------------"
-        print "THE WINNER IS: " + first_player + "."
-        print "-------------------------\n\n"
-
-    def stats(self):
+            pairings = swiss_pairings(standings)
+
+            # register next round matches, the first player of a pair wins
+            report_matches([(pid1, pid2) for (pid1, pname1, pid2, pname2)
+                            in pairings])
+
+            print('\nStats after round: ' + str(i + 1))
+
+            # show round statistics, reused to pair the next round
+            standings = player_standings()
+            first_player = self.stats(standings)
+            print('\n')
+
+        print("-------------------------")
+        print("THE WINNER IS: " + first_player + ".")
+        print("-------------------------\n\n")
+
+    def stats(self, standings):
         """Display player_standings.
 
          Id | Name | Wins | Matches
          1 | Player 1 | 1 | 1
          2 | Player 2 | 0 | 1
 
+        Args:
+            standings: the player_standings() to display
+
         Returns:
             first player's name
         """
-        standings = player_standings()
-
-        print '----------------------------'
-        print 'Id | Name | Wins | Matches'
-        print '----------------------------'
-        j = 0
-        while j < self.NR_OF_PLAYERS:
-            print str(standings[j][0]) + " | " + str(standings[j][1]) + " | " \
-                + str(standings[j][2]) + " | " + str(standings[j][3])
-            j += 1
+        lines = ['----------------------------',
+                 'Id | Name | Wins | Matches',
+                 '----------------------------']
+        lines.extend("%d | %s | %d | %d" % row for row in standings)
+        # write the whole table at once instead of one print per line
+        sys.stdout.write("\n".join(lines) + "\n")
 
         return standings[0][1]
 
 
 if __name__ == '__main__':
-    tournament = SwissTournament()
-    tournament.generate_whole_swiss_tournament()
+    # the whole tournament is only displayed when asked for, with --tournament
+    if '--tournament' in sys.argv:
+        sys.argv.remove('--tournament')
+        SwissTournament().generate_whole_swiss_tournament()
     unittest.main()